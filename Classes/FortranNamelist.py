@@ -1,10 +1,25 @@
 """Define a fortran namelist file class"""
+import copy
+import gzip
+import hashlib
 import os
 import re
+import sys
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 try:
     import numpy as np
 except:
     print "ERROR: Couldn't import numpy, may well find errors later on."
+#Only needed for reading .xz files
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma=None
 
 #Some settings
 DEBUG=False
@@ -15,7 +30,11 @@ _NmlStartReg=re.compile(r"^ *&([^ !]+)")
 _NmlEndReg=re.compile(r"(^[^!]* |^ *)/") 
 #Note here we assume there will never be a variable with ! in it's name
 #and the value will never contain !
-_KeyValSplit=re.compile(r"^([ a-zA-Z_]+)=([^!/]+)(!.*)?$")
+#/Keys can be plain names, indexed/sectioned (e.g. temp(1:100), coef(3))
+#/or derived type components (e.g. species(2)%mass)
+_KeyString=r"[a-zA-Z_][a-zA-Z0-9_]*(?: *\([^()=]*\))?(?: *% *[a-zA-Z_][a-zA-Z0-9_]*(?: *\([^()=]*\))?)*"
+_KeyValSplit=re.compile(r"^ *("+_KeyString+r") *=([^!/]+)(!.*)?$")
+_KeyPart=re.compile(r"^ *([a-zA-Z_][a-zA-Z0-9_]*) *(?:\(([^()]*)\))? *$")
 #/Type regexp
 _True=re.compile(r"^(\.t\.|\.true\.|t|true)$",re.I)
 _False=re.compile(r"^(\.f\.|\.false\.|f|false)$",re.I)
@@ -26,46 +45,232 @@ _Number=re.compile(r"^"+_NumString+r"$",re.I)
 _Int=re.compile(r"^[+-]?[0-9]+$")
 _Complex=re.compile(r"^\(("+_NumString+r"),("+_NumString+r")\)$")
 
+def _NumpyType(Types):
+    """Return the numpy dtype to use to hold values of the passed fortran types."""
+    Types=set(Types)
+    if Types.issubset(set(["integer"])):
+        return int
+    elif Types.issubset(set(["integer","real"])):
+        return float
+    elif Types.issubset(set(["integer","real","complex"])):
+        return complex
+    elif Types.issubset(set(["logical"])):
+        return bool
+    else:
+        return object
+
+def _FindNml(Lines):
+    """Find the namelists in the passed lines, returns the namelist names and
+    the indices of their start and end lines."""
+    NmlNames=[]
+    LineStart=[]
+    LineEnd=[]
+    for Name,Block,Start,End in _IterNml(Lines,Keep=False):
+        NmlNames.append(Name)
+        LineStart.append(Start)
+        LineEnd.append(End)
+
+    #Count the namelists
+    if NmlNames.__len__()==0:
+        raise(RuntimeError("No namelists present in file."))
+
+    return NmlNames,LineStart,LineEnd
+
+def _HashLines(Lines):
+    """Return a hash of the passed lines, used to spot changed namelists."""
+    return hashlib.md5("\n".join(Lines)).hexdigest()
+
+def _OpenStream(Source):
+    """Return an iterable over the lines of Source, which may be a filename
+    (.gz and .xz files are decompressed on the fly), '-' for stdin, or an
+    already open file-like object."""
+    if not isinstance(Source,basestring):
+        return Source
+    if Source=="-":
+        return sys.stdin
+    if not os.path.exists(Source):
+        raise(IOError("Filename '"+Source+"' doesn't exist"))
+    if Source.endswith(".gz"):
+        return gzip.open(Source,'rb')
+    if Source.endswith(".xz"):
+        if lzma is None:
+            raise(IOError("Need the lzma module to read '"+Source+"'"))
+        return lzma.open(Source,'rb')
+    return open(Source,'r')
+
+def _IterNml(Lines,Keep=True):
+    """Generator yielding (Name,Lines,Start,End) for each namelist block in the
+    passed iterable of lines, where Start and End are the indices of the first and
+    last lines of the block. Only one block is held at a time, and if Keep is False
+    the block lines aren't kept at all (None is returned instead). As in
+    FortranNamelistFile the line containing the namelist end isn't included."""
+    Name=None
+    Block=[]
+    Start=None
+    for num,Line in enumerate(Lines):
+        Line=Line.strip()
+
+        #Does line match the namelist regex
+        tmp=_NmlStartReg.match(Line)
+        if not tmp is None:
+            if not Name is None:
+                raise(RuntimeError("Namelist '{N}' started before '{P}' ended".format(
+                            N=tmp.groups()[0],P=Name)))
+            Name=tmp.groups()[0]
+            Block=[]
+            Start=num
+
+        #Does line match the end of namelist regex
+        #Note that strictly a line can both start and end a namelist
+        #so we have to test all lines for both.
+        tmp=_NmlEndReg.match(Line)
+        if not tmp is None:
+            if Name is None:
+                raise(RuntimeError("Namelist end found outside of a namelist."))
+            yield Name,(Block if Keep else None),Start,num
+            Name=None
+            Block=[]
+        elif Keep and not Name is None:
+            Block.append(Line)
+
+    if not Name is None:
+        raise(RuntimeError("Namelist '{N}' has no end.".format(N=Name)))
+
+def IterNamelists(Source=None):
+    """Generator yielding (Name,FortranNamelist) for each namelist in Source as
+    it is read, so memory use is set by the largest namelist rather than the
+    whole file. Source may be a filename (including .gz/.xz), '-' for stdin or
+    a file-like object."""
+    if Source is None:
+        raise(RuntimeError("Must pass Source to read namelists from"))
+
+    Stream=_OpenStream(Source)
+    try:
+        for Name,Lines,Start,End in _IterNml(Stream):
+            yield Name,FortranNamelist(Lines=Lines)
+    finally:
+        #Only close what we opened
+        if isinstance(Source,basestring) and Stream is not sys.stdin:
+            Stream.close()
+
+def IterKeyVals(Source=None):
+    """Generator yielding (Namelist name,Key,Value) for each key in Source, where
+    Value is the typed python value (a numpy array for arrays).
+    See IterNamelists for the allowed Source."""
+    for Name,Nml in IterNamelists(Source=Source):
+        for KV in Nml.KeyVal:
+            if not KV.Key:
+                continue
+            if KV.ValObj.IsArray:
+                yield Name,KV.Key,np.array(KV.ValObj._Flatten())
+            else:
+                yield Name,KV.Key,KV.ValObj.Val
+
+def _ReadFile(Args):
+    """Read the lines of a file, used by LoadFiles."""
+    Filename,Opener=Args
+    try:
+        with Opener(Filename,'r') as ff:
+            return Filename,ff.readlines()
+    except IOError as Err:
+        raise(IOError(Err.errno,"Problem reading file : {E}".format(E=Err.strerror),Filename))
+
+def _ParseFile(Filename,Lines):
+    """Make a FortranNamelistFile from already read lines, used by LoadFiles."""
+    return Filename,FortranNamelistFile(Filename=Filename,Lines=Lines)
+
+def LatencyOpener(Latency=0.01):
+    """Return an opener for LoadFiles which waits Latency seconds before each open,
+    a local stand-in for a high latency filesystem. For example comparing
+            list(LoadFiles(Filenames,Concurrency=1,Workers=0,Opener=LatencyOpener()))
+            list(LoadFiles(Filenames,Opener=LatencyOpener()))
+    shows how much of the latency is hidden by overlapping the reads."""
+    def Opener(Filename,Mode='r'):
+        time.sleep(Latency)
+        return open(Filename,Mode)
+    return Opener
+
+def LoadFiles(Filenames=None,Concurrency=64,Workers=None,Opener=open,Timeout=None):
+    """Generator yielding (Filename,FortranNamelistFile) for each of Filenames in
+    the order they finish loading. Intended for filesystems where each open/read
+    has a high latency:
+            *) Up to Concurrency files are read at once by a pool of threads.
+            *) Parsing is done by a pool of Workers processes (defaults to the number
+               of cpus), set Workers=0 to parse in this process instead.
+            *) Opener is used to open the files, e.g. to read from somewhere other
+               than the local filesystem (or LatencyOpener to add latency when testing).
+            *) If a parse worker dies (e.g. is killed for using too much memory) while
+               files are still being parsed then a RuntimeError is raised, as its file
+               would otherwise never finish.
+            *) If Timeout is not None and no parse finishes for Timeout seconds then a
+               RuntimeError is also raised. By default there's no limit, as parsing a
+               very large file can legitimately take a long time.
+    Errors reading or parsing a file are raised when it is reached."""
+    if Filenames is None:
+        raise(RuntimeError("Must pass Filenames to load"))
+    if isinstance(Filenames,basestring):
+        Filenames=[Filenames]
+
+    #Note the process pool must be made (forked) before any threads are started
+    ParsePool=None if Workers==0 else Pool(Workers)
+    ReadPool=ThreadPool(max(1,min(Concurrency,Filenames.__len__())))
+    #Pool replaces workers that die, so a change in the worker processes
+    #means one has died (note _pool is private to multiprocessing)
+    Workers=None if ParsePool is None else set(map(lambda x:x.pid,ParsePool._pool))
+    try:
+        #Hand each file to the parsers as soon as it has been read and
+        #pass back any that have been parsed in the meantime
+        Pending=[]
+        for Filename,Lines in ReadPool.imap_unordered(_ReadFile,map(lambda x:(x,Opener),Filenames)):
+            if ParsePool is None:
+                yield _ParseFile(Filename,Lines)
+                continue
+            Pending.append((Filename,ParsePool.apply_async(_ParseFile,(Filename,Lines))))
+            for Res in filter(lambda x:x[1].ready(),Pending):
+                Pending.remove(Res)
+                yield Res[1].get()
+
+        #Now wait for the rest, in the order they finish
+        LastDone=time.time()
+        while Pending.__len__()>0:
+            Ready=filter(lambda x:x[1].ready(),Pending)
+            if Ready.__len__()==0:
+                if set(map(lambda x:x.pid,ParsePool._pool)) != Workers:
+                    raise(RuntimeError("A parse worker died while waiting to parse '{F}'".format(
+                                F=Pending[0][0])))
+                if Timeout is not None and time.time()-LastDone>Timeout:
+                    raise(RuntimeError("Timed out waiting to parse '{F}'".format(F=Pending[0][0])))
+                Pending[0][1].wait(0.01)
+                continue
+            for Res in Ready:
+                Pending.remove(Res)
+                yield Res[1].get()
+            LastDone=time.time()
+    finally:
+        ReadPool.terminate()
+        if ParsePool is not None:
+            ParsePool.terminate()
+
 class FortranNamelistFile:
     """A class representing a fortran namelist file."""
-    def __init__(self,Filename=None):
-        if not os.path.exists(Filename):
-            raise(IOError("Filename '"+Filename+"' doesn't exist"))
+    def __init__(self,Filename=None,Lines=None):
+        """Read the namelists in Filename. If Lines is passed then these are used
+        instead of reading the file (Filename is still recorded for Reload)."""
+        if Lines is None:
+            if not os.path.exists(Filename):
+                raise(IOError("Filename '"+Filename+"' doesn't exist"))
         
-        #Open the file and read all the lines
-        if DEBUG:
-            print "Reading file '{F}'".format(F=Filename)
-        with open(Filename,'r') as ff:
-            Lines=map(lambda x:x.strip(),ff.readlines())
+            #Open the file and read all the lines
+            if DEBUG:
+                print "Reading file '{F}'".format(F=Filename)
+            with open(Filename,'r') as ff:
+                Lines=ff.readlines()
+        Lines=map(lambda x:x.strip(),Lines)
+        self.Filename=Filename
 
         #Loop through lines to find namelist specifiers
-        self.NmlNames=[]
-        LineStart=[]
-        LineEnd=[]
-        for num,Line in enumerate(Lines):
-            #Does line match the namelist regex
-            tmp=_NmlStartReg.match(Line)
-            #If match
-            if not tmp is None:
-                self.NmlNames.append(tmp.groups()[0])
-                LineStart.append(num)
-
-            #Does line match the end of namelist regex
-            #Note that strictly a line can both start and end a namelist
-            #so we have to test all lines for both.
-            tmp=_NmlEndReg.match(Line)
-            if not tmp is None:
-                LineEnd.append(num)
-
-        #Count the namelists
+        self.NmlNames,LineStart,LineEnd=_FindNml(Lines)
         self.NumNml=self.NmlNames.__len__()
-        if self.NumNml==0:
-            raise(RuntimeError("No namelists present in file."))
-
-        #Make sure we have the right number of starts and ends
-        if not self.NumNml == LineEnd.__len__():
-            raise(RuntimeError("Mismatch in number of starts ({S}) and ends ({E})".format(
-                        S=self.NumNml,E=LineEnd.__len__())))
 
         #Some debug reporting
         if DEBUG:
@@ -78,7 +283,8 @@ class FortranNamelistFile:
         for num,name in enumerate(self.NmlNames):
             #Note here we don't pass the last line, usually containing the namelist end /
             self.Namelists.append(FortranNamelist(Lines=Lines[LineStart[num]:LineEnd[num]]))
-
+            #Remember what the block looked like so Reload can spot changes
+            self.Namelists[-1]._Hash=_HashLines(Lines[LineStart[num]:LineEnd[num]+1])
 
         #Align the namelists
         self._AlignAll()
@@ -105,8 +311,8 @@ class FortranNamelistFile:
         """Setup the alignment of each namelist"""
         #Align namelists
         #/First get max lengths
-        MaxKeyLen=max(map(lambda x:x.MaxKeyLen,self.Namelists))
-        MaxValLen=max(map(lambda x:x.MaxValLen,self.Namelists))
+        MaxKeyLen=max([0]+map(lambda x:x.MaxKeyLen,self.Namelists))
+        MaxValLen=max([0]+map(lambda x:x.MaxValLen,self.Namelists))
 
         #/Now set these values in all namelists
         jnk=map(lambda x:x._AlignKeyVals(MaxKeyLen=MaxKeyLen,MaxValLen=MaxValLen,
@@ -250,6 +456,90 @@ class FortranNamelistFile:
 
         return
 
+    def Reload(self):
+        """Re-read the file, only re-parsing the namelists whose text has changed.
+        Namelist objects for unchanged blocks are kept (including any changes made
+        to them since they were read), those for changed blocks are replaced so any
+        changes made to them are lost. Namelists added with AddNml (rather than read
+        from the file) are kept and placed after those from the file. Namelists are
+        matched up by name and, where there are several with the same name, the order
+        they appear in. Returns a dictionary describing what changed:
+                *) 'Added'   : Names of namelists that are new
+                *) 'Removed' : Names of namelists that have gone
+                *) 'Changed' : Dictionary of {Name:{'Added':[Keys],'Removed':[Keys],'Changed':[Keys]}}
+                               only for namelists whose keys, values or comments differ"""
+        if not os.path.exists(self.Filename):
+            raise(IOError("Filename '"+self.Filename+"' doesn't exist"))
+
+        if DEBUG:
+            print "Reloading file '{F}'".format(F=self.Filename)
+        with open(self.Filename,'r') as ff:
+            Lines=map(lambda x:x.strip(),ff.readlines())
+        NmlNames,LineStart,LineEnd=_FindNml(Lines)
+
+        #Group the existing namelists by name so we can match them up
+        #(only those that were read from the file)
+        Old={}
+        for Nml in self.Namelists:
+            if Nml._Hash is not None:
+                Old.setdefault(Nml.Name.lower(),[]).append(Nml)
+
+        Changes={'Added':[],'Removed':[],'Changed':{}}
+        Namelists=[]
+        Seen={}
+        for num,name in enumerate(NmlNames):
+            Hash=_HashLines(Lines[LineStart[num]:LineEnd[num]+1])
+            Ind=Seen.get(name.lower(),0)
+            Seen[name.lower()]=Ind+1
+            Prev=Old.get(name.lower(),[])
+            Prev=Prev[Ind] if Ind<Prev.__len__() else None
+
+            #Unchanged so keep the existing object
+            if Prev is not None and Prev._Hash==Hash:
+                Namelists.append(Prev)
+                continue
+
+            #Otherwise parse the new block
+            Nml=FortranNamelist(Lines=Lines[LineStart[num]:LineEnd[num]])
+            Nml._Hash=Hash
+            Namelists.append(Nml)
+            if Prev is None:
+                Changes['Added'].append(name)
+            else:
+                #Formatting only changes don't count
+                Diff=Nml._DiffKeys(Prev)
+                if not any(Diff.values()):
+                    continue
+                Diff0=Changes['Changed'].setdefault(name,{'Added':[],'Removed':[],'Changed':[]})
+                for Key,Val in Diff.items():
+                    Diff0[Key].extend(Val)
+
+        #Anything left over has been removed
+        for name,Prev in Old.items():
+            for Nml in Prev[Seen.get(name,0):]:
+                Changes['Removed'].append(Nml.Name)
+
+        #Keep any namelists added in memory
+        Namelists.extend(filter(lambda x:x._Hash is None,self.Namelists))
+
+        #Store the new state
+        self.NmlNames=map(lambda x:x.Name,Namelists)
+        self.NumNml=Namelists.__len__()
+        self.Namelists=Namelists
+
+        #Update
+        self._Update()
+
+        return Changes
+
+    def Clone(self):
+        """Return a cheap copy of the file object, each namelist is cloned
+        (see FortranNamelist.Clone) so data is only copied when it's modified."""
+        New=copy.copy(self)
+        New.NmlNames=list(self.NmlNames)
+        New.Namelists=map(lambda x:x.Clone(),self.Namelists)
+        return New
+
     def GetDict(self):
         """A function to return a dictionary representation of the namelist file."""
         fil_dict={}
@@ -261,6 +551,78 @@ class FortranNamelistFile:
                 fil_dict[self.NmlNames[num]]=[Nml._AsDict()]
         return fil_dict
 
+    def GetArrays(self):
+        """A function to return a dictionary of the assembled arrays in each namelist
+        (see FortranNamelist.GetArrays)."""
+        fil_dict={}
+        for num,Nml in enumerate(self.Namelists):
+            #Have to guard against multiple namelists with the same name
+            if self.NmlNames[num] in fil_dict.keys():
+                fil_dict[self.NmlNames[num]].append(Nml.GetArrays())
+            else:
+                fil_dict[self.NmlNames[num]]=[Nml.GetArrays()]
+        return fil_dict
+
+class FortranNamelistWatcher:
+    """A class to poll a set of namelist files and reload them when they change."""
+    def __init__(self,Filenames=None,Interval=1.0):
+        if Filenames is None:
+            raise(RuntimeError("Must pass Filenames to watch"))
+        if isinstance(Filenames,basestring):
+            Filenames=[Filenames]
+
+        self.Interval=Interval
+        self.Files={}
+        self.Stats={}
+        for Filename in Filenames:
+            self.Files[Filename]=FortranNamelistFile(Filename=Filename)
+            self.Stats[Filename]=self._Stat(Filename)
+
+        return
+
+    def _Stat(self,Filename):
+        """Return the bits of os.stat used to decide if a file may have changed."""
+        tmp=os.stat(Filename)
+        return (tmp.st_mtime,tmp.st_size)
+
+    def Poll(self):
+        """Check each file once and reload those that have been modified.
+        Returns a dictionary of {Filename:Changes} (see FortranNamelistFile.Reload)
+        for files whose namelists changed. Files that are missing or can't be parsed
+        are skipped and checked again on the next poll."""
+        Changed={}
+        for Filename,Fil in self.Files.items():
+            #A file may be missing while it's being replaced, skip it until it's back
+            try:
+                Stat=self._Stat(Filename)
+            except OSError:
+                continue
+            if Stat==self.Stats[Filename]:
+                continue
+
+            #A file may be caught half written (or otherwise fail to parse), in which
+            #case try again next time rather than stopping the other files being checked
+            try:
+                Changes=Fil.Reload()
+            except Exception as Err:
+                print "Warning: Couldn't reload '{F}' : {E}".format(F=Filename,E=Err)
+                continue
+            self.Stats[Filename]=Stat
+            if Changes['Added'] or Changes['Removed'] or Changes['Changed']:
+                Changed[Filename]=Changes
+        return Changed
+
+    def Watch(self,Count=None):
+        """Generator which polls every Interval seconds and yields (Filename,Changes)
+        for each modified file. Stops after Count polls if Count is not None."""
+        Polls=0
+        while Count is None or Polls<Count:
+            for Filename,Changes in self.Poll().items():
+                yield Filename,Changes
+            Polls+=1
+            if Count is None or Polls<Count:
+                time.sleep(self.Interval)
+
 class FortranNamelist:
     """A class representing a fortran namelist."""
     def __init__(self,Lines=None,Name=None):
@@ -274,6 +636,13 @@ class FortranNamelist:
         self.KeyVal=[]
         self.MaxKeyLen=0
         self.MaxValLen=0
+        #Hash of the file block this namelist was read from (if any)
+        self._Hash=None
+        #Are the lists above shared with a clone (see Clone)
+        self._Shared=False
+        #Alignment used when printing the KeyVal objects, this is kept here rather
+        #than on the KeyVal objects so they can be shared with clones
+        self._Alignment={}
 
         #If no lines passed then just make empty objects
         if Lines is None:
@@ -310,8 +679,8 @@ class FortranNamelist:
                     self.Comments.append(Com)
  
         #Get some info
-        self.MaxKeyLen=max(map(lambda x: x.KeyLen,self.KeyVal))
-        self.MaxValLen=max(map(lambda x: x.ValLen,self.KeyVal))
+        self.MaxKeyLen=max([0]+map(lambda x: x.KeyLen,self.KeyVal))
+        self.MaxValLen=max([0]+map(lambda x: x.ValLen,self.KeyVal))
 
         return
 
@@ -322,6 +691,7 @@ class FortranNamelist:
             return
 
         #Append data
+        self._Own()
         self.Keys.append(KeyVal.Key)
         self.Vals.append(KeyVal.Val)
         self.Comments.append(KeyVal.Com)
@@ -396,6 +766,7 @@ class FortranNamelist:
             #Note here we iteratively remove the first matching namelist
             Ans=[self.DelKey(Name=Name,Index=0,Warn=Warn,Pop=Pop) for x in xrange(KeyCount)]
         else:
+            self._Own()
             jnk=self.Keys.pop(nind[Index])
             jnk=self.Vals.pop(nind[Index])
             jnk=self.Comments.pop(nind[Index])
@@ -414,14 +785,69 @@ class FortranNamelist:
         """Remove KeyVal from file and return removed KeyVal object."""
         return self.DelKey(Name=Name,Index=Index,Warn=Warn,Pop=True)
 
+    def SetVal(self,Name=None,Val=None,Com=None,Index=0):
+        """Set the value (a string, as it would appear in the file) of the selected key.
+        The KeyVal object is replaced rather than modified so any clones sharing it are
+        unaffected. If Com is None the existing comment is kept. If there are multiple
+        keys with the same name then Index selects which one to set."""
+        if Name is None or Val is None:
+            print "ERROR: Have to specify the name of the key and the value to set"
+            return
+
+        #Find the matching key
+        tmp=self.HasKey(Name=Name,Count=True,Matches=True)
+        if tmp[0]==0:
+            print "ERROR: Namelist doesn't contain '{N}' key".format(N=Name)
+            return
+        nind=[x[1] for x in zip(tmp[1],range(tmp[1].__len__())) if x[0]]
+        ind=nind[min(Index,nind.__len__()-1)]
+
+        #Make the new KeyVal and store
+        Old=self.KeyVal[ind]
+        if Com is None:
+            Com=Old.Com
+        KeyVal=FortranKeyVal(Key=Old.Key,Val=Val,Com=Com)
+        self._Own()
+        self.Vals[ind]=KeyVal.Val
+        self.Comments[ind]=KeyVal.Com
+        self.KeyVal[ind]=KeyVal
+
+        #Update
+        self._Update()
+
+        return
+
+    def Clone(self):
+        """Return a cheap copy of this namelist. The key/val lists are shared with the
+        original until either is modified with AddKeyVal, DelKey or SetVal, at which point
+        that namelist takes its own copy of the lists. The KeyVal objects themselves are
+        always shared, SetVal replaces the one it changes and alignment is kept on the
+        namelist. Note changing values in place (e.g. KV.ValObj.Val, or an array from GetDict)
+        rather than with SetVal still changes every clone sharing that KeyVal."""
+        New=copy.copy(self)
+        New._Shared=True
+        self._Shared=True
+        return New
+
+    def _Own(self):
+        """Take private copies of the lists shared with clones, call before modifying them.
+        Only the lists are copied, the KeyVal objects in them are still shared."""
+        if not self._Shared:
+            return
+        self.Keys=list(self.Keys)
+        self.Vals=list(self.Vals)
+        self.Comments=list(self.Comments)
+        self.KeyVal=list(self.KeyVal)
+        self._Shared=False
+
     def _Update(self):
         """A function to call to update object"""
         #Update children
         jnk=map(lambda x:x._Update(),self.KeyVal)
 
         #Update alignment
-        self.MaxKeyLen=max(map(lambda x: x.KeyLen,self.KeyVal))
-        self.MaxValLen=max(map(lambda x: x.ValLen,self.KeyVal))
+        self.MaxKeyLen=max([0]+map(lambda x: x.KeyLen,self.KeyVal))
+        self.MaxValLen=max([0]+map(lambda x: x.ValLen,self.KeyVal))
 
         #Update allignments
         self._AlignKeyVals()
@@ -435,32 +861,55 @@ class FortranNamelist:
             if self.MaxKeyLen >0:
                 MaxKeyLen=self.MaxKeyLen
             else:
-                MaxKeyLen=max(map(lambda x: x.KeyLen,self.KeyVal))                
+                MaxKeyLen=max([0]+map(lambda x: x.KeyLen,self.KeyVal))                
         if MaxValLen is None:
             if self.MaxValLen >0:
                 MaxValLen=self.MaxValLen
             else:
-                MaxValLen=max(map(lambda x: x.ValLen,self.KeyVal))
+                MaxValLen=max([0]+map(lambda x: x.ValLen,self.KeyVal))
 
         #Store new values
         self.MaxKeyLen=MaxKeyLen
         self.MaxValLen=MaxValLen
 
-        #Set alignment parameters
-        for j in self.KeyVal:
-            j._SetAlignment(MaxKeyLen=MaxKeyLen,MaxValLen=MaxValLen,
-                            KeyIndent=KeyIndent,EqPad=EqPad,
-                            ComIndent=ComIndent,LeftIndentKey=LeftIndentKey,
-                            LeftIndentVal=LeftIndentVal)
+        #Set alignment parameters, the others are only changed if passed.
+        #Note a new dictionary is made as clones start off sharing this one
+        Alignment=dict(self._Alignment)
+        Alignment['MaxKeyLen']=MaxKeyLen
+        Alignment['MaxValLen']=MaxValLen
+        for Key,Val in [('KeyIndent',KeyIndent),('EqPad',EqPad),('ComIndent',ComIndent),
+                        ('LeftIndentKey',LeftIndentKey),('LeftIndentVal',LeftIndentVal)]:
+            if not Val is None:
+                Alignment[Key]=Val
+        self._Alignment=Alignment
 
     def __str__(self):
         """What to print"""
         Str=[]
         Str.append("&{NM}".format(NM=self.Name))
-        for j in self.KeyVal: Str.append(j.__str__())
+        for j in self.KeyVal: Str.append(j._Format(**self._Alignment))
         Str.append("/")
         return "\n".join(Str)
 
+    def _DiffKeys(self,Other):
+        """Compare the keys in this namelist to those in Other, returns a dictionary
+        of the keys which have been added, removed or changed (value or comment)."""
+        Mine=dict(map(lambda x:(x.Key.lower(),x),filter(lambda x:x.Key,self.KeyVal)))
+        Theirs=dict(map(lambda x:(x.Key.lower(),x),filter(lambda x:x.Key,Other.KeyVal)))
+        Diff={'Added':[],'Removed':[],'Changed':[]}
+        for KV in self.KeyVal:
+            if not KV.Key:
+                continue
+            if not KV.Key.lower() in Theirs:
+                Diff['Added'].append(KV.Key)
+            elif (KV.ValObj.__str__() != Theirs[KV.Key.lower()].ValObj.__str__() or
+                  KV.Com != Theirs[KV.Key.lower()].Com):
+                Diff['Changed'].append(KV.Key)
+        for KV in Other.KeyVal:
+            if KV.Key and not KV.Key.lower() in Mine:
+                Diff['Removed'].append(KV.Key)
+        return Diff
+
     def _AsDict(self):
         """A function to return a dictionary representation of the namelist."""
         nml_dict={}
@@ -468,6 +917,116 @@ class FortranNamelist:
             nml_dict[KV.Key]=KV.ValObj
         return nml_dict
 
+    def GetArrays(self):
+        """Return a dictionary of numpy arrays, one per array variable, built by merging
+        all the (possibly partial) assignments to that variable, e.g. temp(1:50)=... and
+        temp(51:100)=... give a single temp array. Derived type components are stored
+        under the component path, e.g. species(2)%mass --> species%mass.
+                *) Arrays are masked arrays, elements never assigned are masked.
+                *) Values fill the subscripted section in Fortran (column major) order,
+                   unsubscripted assignments fill the whole array from the first element.
+                *) Open bounds take their extent from the other assignments, except the
+                   last open upper bound which is sized from the number of values.
+                *) Subscripts are assumed to start at 1.
+                *) Variables that can't be assembled are skipped with a warning.
+        The KeyVal entries aren't changed so the original sparse form is still written out."""
+        #First pass -- collect the assignments to each variable and work out its
+        #shape and type so each array only has to be allocated once
+        Names={}
+        Assign={}
+        Order=[]
+        for KV in self.KeyVal:
+            if not KV.Key:
+                continue
+            Vals=KV.ValObj._Flatten()
+            Index=KV.KeyObj.Index
+            Var=KV.KeyObj.Name.lower()
+            if not Var in Assign:
+                Names[Var]=KV.KeyObj.Name
+                Assign[Var]=[]
+                Order.append(Var)
+            Assign[Var].append((KV,Index,Vals))
+
+        Arrays={}
+        for Var in Order:
+            #Only interested in variables that are actually arrays
+            if not any(map(lambda x:x[0].KeyObj.Index is not None or x[0].ValObj.IsArray,Assign[Var])):
+                continue
+
+            #Don't let one bad variable stop the rest being assembled
+            try:
+                Arrays[Names[Var]]=self._AssembleArray(Assign[Var])
+            except RuntimeError as Err:
+                print "Warning: Couldn't assemble array '{V}' : {E}".format(V=Names[Var],E=Err)
+
+        return Arrays
+
+    def _AssembleArray(self,Assign):
+        """Build the array for one variable from its list of (KeyVal,Index,Vals)
+        assignments, see GetArrays. Index is None for unsubscripted assignments."""
+        #Unsubscripted assignments fill from the first element of the whole array
+        #so take their rank from the subscripted ones
+        Ranks=set(map(lambda x:x[1].__len__(),filter(lambda x:x[1] is not None,Assign)))
+        if Ranks.__len__()>1:
+            raise(RuntimeError("Inconsistent rank in assignments"))
+        Rank=Ranks.pop() if Ranks else 1
+
+        #/Work out the extent of each dimension from the closed bounds
+        Shape=[0]*Rank
+        Types=set()
+        for KV,Index,Vals in Assign:
+            Types.update(KV.ValObj._Types())
+            if Index is None:
+                continue
+            for Dim,(Start,Stop,Stride) in enumerate(Index):
+                Shape[Dim]=max([Shape[Dim]]+filter(lambda x:x is not None,[Start,Stop]))
+
+        #/Now get the elements each assignment covers. Open bounds span the known extent
+        #except for the last open upper bound, which is sized from the number of values
+        #(as values fill the section in column major order)
+        Sections=[]
+        for KV,Index,Vals in Assign:
+            if Index is None:
+                Index=[(None,None,1)]*Rank
+            Fill=[Dim for Dim,(Start,Stop,Stride) in enumerate(Index) if Stop is None and Stride>0]
+            Fill=Fill[-1] if Fill else None
+            Ranges=[None]*Rank
+            for Dim,(Start,Stop,Stride) in enumerate(Index):
+                if Stride==0:
+                    raise(RuntimeError("Zero stride in assignment to {K}".format(K=KV.Key)))
+                if Dim==Fill:
+                    continue
+                if Start is None:
+                    Start=1 if Stride>0 else Shape[Dim]
+                if Stop is None:
+                    Stop=Shape[Dim] if Stride>0 else 1
+                if Start<1 or Stop<1:
+                    raise(RuntimeError("Can't work out the extent of dimension {D} in assignment to {K}".format(
+                                D=Dim+1,K=KV.Key)))
+                Ranges[Dim]=np.arange(Start-1,Stop,Stride) if Stride>0 else np.arange(Start-1,Stop-2,Stride)
+            if Fill is not None:
+                Start,Stop,Stride=Index[Fill]
+                Start=1 if Start is None else Start
+                Other=int(np.prod(map(len,filter(lambda x:x is not None,Ranges))))
+                if Other==0 or Start<1:
+                    raise(RuntimeError("Can't work out the extent of dimension {D} in assignment to {K}".format(
+                                D=Fill+1,K=KV.Key)))
+                Ranges[Fill]=np.arange(Start-1,Start-1+(-(-Vals.__len__()//Other))*Stride,Stride)
+            if Vals.__len__()>np.prod(map(len,Ranges)):
+                raise(RuntimeError("Too many values ({N}) in assignment to {K}".format(
+                            N=Vals.__len__(),K=KV.Key)))
+            for Dim,Range in enumerate(Ranges):
+                if Range.__len__()>0:
+                    Shape[Dim]=max(Shape[Dim],Range.max()+1)
+            Sections.append((Ranges,Vals))
+
+        #/Second pass -- allocate once and fill in each section in order
+        Arr=np.ma.masked_all(Shape,dtype=_NumpyType(Types))
+        for Ranges,Vals in Sections:
+            Pos=np.unravel_index(np.arange(Vals.__len__()),map(len,Ranges),order='F')
+            Arr[tuple(map(lambda x:x[0][x[1]],zip(Ranges,Pos)))]=Vals
+        return Arr
+
 class FortranKeyVal:
     """A class to represent a key-val-comment line."""
     def __init__(self,Key=None,Val=None,Com=None):
@@ -542,56 +1101,84 @@ class FortranKeyVal:
     def _SetAlignment(self,MaxKeyLen=None,MaxValLen=None,EqPad=None,KeyIndent=None,
                       ComIndent=None,LeftIndentKey=None,LeftIndentVal=None):
         """Sets the alignment of fields for printing."""
-        if not EqPad is None:
-            self.EqPad=EqPad
-        if not KeyIndent is None:
-            self.KeyIndent=KeyIndent
-        if not ComIndent is None:
-            self.ComIndent=ComIndent
-        if not LeftIndentKey is None:
-            self.LeftIndentKey=LeftIndentKey
-        if not LeftIndentVal is None:
-            self.LeftIndentVal=LeftIndentVal
+        (self.EqPad,self.KeyIndent,self.ComIndent,self.LeftIndentKey,self.LeftIndentVal,
+         self.EqIndent,self.ValIndent)=self._GetAlignment(
+            MaxKeyLen=MaxKeyLen,MaxValLen=MaxValLen,EqPad=EqPad,KeyIndent=KeyIndent,
+            ComIndent=ComIndent,LeftIndentKey=LeftIndentKey,LeftIndentVal=LeftIndentVal)
+
+        return
+
+    def _GetAlignment(self,MaxKeyLen=None,MaxValLen=None,EqPad=None,KeyIndent=None,
+                      ComIndent=None,LeftIndentKey=None,LeftIndentVal=None):
+        """Return the alignment _SetAlignment would store, without storing it.
+        With no arguments this is the object's own alignment."""
+        if EqPad is None:
+            EqPad=self.EqPad
+        if KeyIndent is None:
+            KeyIndent=self.KeyIndent
+        if ComIndent is None:
+            ComIndent=self.ComIndent
+        if LeftIndentKey is None:
+            LeftIndentKey=self.LeftIndentKey
+        if LeftIndentVal is None:
+            LeftIndentVal=self.LeftIndentVal
 
         #How much space do we need to add to the end of Key
         #to make it line up?
-        self.EqIndent=MaxKeyLen-self.KeyLen+self.EqPad
+        if MaxKeyLen is None:
+            EqIndent=self.EqIndent
+        else:
+            EqIndent=MaxKeyLen-self.KeyLen+EqPad
         
         #How much space do we need to add to the start of val
         #to make it line up?
-        self.ValIndent=MaxValLen-self.ValLen+self.EqPad
+        if MaxValLen is None:
+            ValIndent=self.ValIndent
+        else:
+            ValIndent=MaxValLen-self.ValLen+EqPad
 
-        return
+        return (EqPad,KeyIndent,ComIndent,LeftIndentKey,LeftIndentVal,EqIndent,ValIndent)
 
     def __str__(self):
         """What do we print"""
+        return self._Format()
+
+    def _Format(self,MaxKeyLen=None,MaxValLen=None,EqPad=None,KeyIndent=None,
+                ComIndent=None,LeftIndentKey=None,LeftIndentVal=None):
+        """Return the string representation using the passed alignment, falling back
+        to the object's own for anything not passed. Nothing is stored, so a namelist
+        can print KeyVal objects it shares with clones using its own alignment."""
         if self.BlankLine:
             return
 
         Prt=""
         
         #Get alignment strings
+        (EqPad,KeyIndent,ComIndent,LeftIndentKey,LeftIndentVal,
+         EqIndent,ValIndent)=self._GetAlignment(
+            MaxKeyLen=MaxKeyLen,MaxValLen=MaxValLen,EqPad=EqPad,KeyIndent=KeyIndent,
+            ComIndent=ComIndent,LeftIndentKey=LeftIndentKey,LeftIndentVal=LeftIndentVal)
 
-        if self.LeftIndentKey:
-            EI=" "*(self.EqIndent)
+        if LeftIndentKey:
+            EI=" "*(EqIndent)
             EIR=""
-            KI=" "*self.KeyIndent
+            KI=" "*KeyIndent
             KIR=""            
         else:
             EI=""
-            EIR=" "*(self.EqIndent)
+            EIR=" "*(EqIndent)
             KI=""
-            KIR=" "*self.KeyIndent
+            KIR=" "*KeyIndent
 
-        if self.LeftIndentVal:
-            VI=" "*self.ValIndent
+        if LeftIndentVal:
+            VI=" "*ValIndent
             VIR=""
             CIR=""
-            CI=" "*self.ComIndent
+            CI=" "*ComIndent
         else:
             VI=""
-            VIR=" "*(self.ValIndent)
-            CIR=" "*self.ComIndent
+            VIR=" "*(ValIndent)
+            CIR=" "*ComIndent
             CI=""
 
         if self.Key:
@@ -629,6 +1216,43 @@ class FortranKey:
         self.KeyString=KeyString
         self.StrLen=self._GetStrLen()
 
+        #Split into the variable name (with any subscripts removed) and
+        #the subscripts, e.g. species(2)%mass(1:3) --> species%mass, [(2,2,1),(1,3,1)]
+        self.Name,self.Index=self._ParseKey()
+
+    def _ParseKey(self):
+        """Split the key into a variable name and a list of (Start,Stop,Stride) subscripts.
+        Index is None if the key has no subscripts. Open bounds are stored as None."""
+        Names=[]
+        Index=[]
+        for Part in self.KeyString.split("%"):
+            tmp=_KeyPart.match(Part)
+            if tmp is None:
+                raise(RuntimeError("Can't parse key {K}".format(K=self.KeyString)))
+            Name,Subs=tmp.groups()
+            Names.append(Name)
+            if Subs is None:
+                continue
+            for Sub in Subs.split(","):
+                Bits=map(lambda x:x.strip(),Sub.split(":"))
+                try:
+                    if Bits.__len__()==1:
+                        Index.append((int(Bits[0]),int(Bits[0]),1))
+                    elif Bits.__len__() in [2,3]:
+                        Start=int(Bits[0]) if Bits[0] else None
+                        Stop=int(Bits[1]) if Bits[1] else None
+                        Stride=int(Bits[2]) if Bits.__len__()==3 and Bits[2] else 1
+                        Index.append((Start,Stop,Stride))
+                    else:
+                        raise(ValueError)
+                except ValueError:
+                    raise(RuntimeError("Can't parse subscript {S} of key {K}".format(
+                                S=Sub,K=self.KeyString)))
+
+        if Index.__len__()==0:
+            Index=None
+        return "%".join(Names),Index
+
     def _Update(self):
         """Update the object"""
         self.StrLen=self._GetStrLen()
@@ -755,3 +1379,17 @@ class FortranVal:
                 return self.Val.__str__()
         except:
             return self.ValString
+
+    def _Flatten(self):
+        """Return a list of the (python) values held by this object."""
+        if self.IsArray:
+            return map(lambda x:x.Val,self.Val)
+        else:
+            return [self.Val]
+
+    def _Types(self):
+        """Return the set of element types held by this object."""
+        if self.IsArray and isinstance(self.Type,list):
+            return set(self.Type)
+        else:
+            return set([self.Type])